@@ -1,14 +1,20 @@
 import csv
+import hashlib
+import hmac
+import io
 import os
+import time
+from collections import Counter
 from pathlib import Path
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Form, Response, BackgroundTasks, Body
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
-from fastapi.responses import JSONResponse
-from slack_sdk import WebClient
+from fastapi import FastAPI, Request, Form, Response, BackgroundTasks
+from fastapi.responses import ORJSONResponse
+from slack_sdk.web.async_client import AsyncWebClient
 from slack_sdk.errors import SlackApiError
 import httpx
-from typing import Dict
+from cachetools import TTLCache
+import orjson
+from typing import Optional
 import uvicorn
 import logging
 
@@ -18,42 +24,63 @@ logger = logging.getLogger("uvicorn")
 env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
-app = FastAPI()
-client = WebClient(token=os.environ['SLACK_TOKEN'])
-BOT_ID = client.api_call("auth.test")['user_id']
-
-tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
-model = GPT2LMHeadModel.from_pretrained('gpt2')
-
-message_counts: Dict[str, int] = {}
+app = FastAPI(default_response_class=ORJSONResponse)
+client = AsyncWebClient(token=os.environ['SLACK_TOKEN'])
+SLACK_SIGNING_SECRET = os.environ['SLACK_SIGNING_SECRET'].encode()
+SUPABASE_URL = os.environ['SUPABASE_URL']
+SUPABASE_KEY = os.environ['SUPABASE_KEY']
+SUPABASE_HEADERS = {
+    "apikey": SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+    "Accept-Encoding": "gzip"
+}
+BOT_ID = None
+BOT_MENTION = None
+http_client: Optional[httpx.AsyncClient] = None
+
+# GPT-2 is served by an external OpenAI-compatible completions endpoint (e.g. vLLM),
+# which batches concurrent requests itself
+LLM_ENDPOINT = os.environ['LLM_ENDPOINT']
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gpt2')
+
+# Generation runs at temperature 0, so replies to the same prompt can be reused
+response_cache: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+message_counts: Counter[str] = Counter()
+MESSAGE_COUNT_TEXT = "Messages: {}"
+
+@app.on_event("startup")
+async def startup():
+    global BOT_ID, BOT_MENTION, http_client
+    auth = await client.auth_test()
+    BOT_ID = auth['user_id']
+    BOT_MENTION = f'<@{BOT_ID}>'
+    http_client = httpx.AsyncClient(timeout=30)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await http_client.aclose()
 
 @app.post('/message-count')
-async def message_count(channel_id: str = Form(...), user_id: str = Form(...)):
-    count = message_counts.get(user_id, 0)
-    try:
-        client.chat_postMessage(channel=channel_id, text=f"Messages: {count}")
-    except SlackApiError as e:
-        error_message = e.response['error']
-        return Response(content=f"Error uploading file: {error_message}", status_code=200)
-
+async def message_count(background_tasks: BackgroundTasks, channel_id: str = Form(...), user_id: str = Form(...)):
+    background_tasks.add_task(send_message_count, channel_id, message_counts[user_id])
     return Response(content='', status_code=200)
 
-async def fetch_data_and_save_as_csv(table_name: str, filename: str):
-    supabase_url = os.environ['SUPABASE_URL']
-    supabase_key = os.environ['SUPABASE_KEY']
-    headers = {
-        "apikey": supabase_key,
-        "Authorization": f"Bearer {supabase_key}"
-    }
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{supabase_url}/rest/v1/{table_name}", headers=headers)
-        data = response.json()
-    csv_file = filename
-    with open(csv_file, mode='w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=data[0].keys())
-        writer.writeheader()
-        writer.writerows(data)
-    return csv_file
+async def send_message_count(channel_id: str, count: int):
+    try:
+        await client.chat_postMessage(channel=channel_id, text=MESSAGE_COUNT_TEXT.format(count))
+    except SlackApiError as e:
+        logger.error(f"Slack API Error: {e.response['error']}")
+
+async def fetch_data_as_csv(table_name: str) -> bytes:
+    response = await http_client.get(f"{SUPABASE_URL}/rest/v1/{table_name}", headers=SUPABASE_HEADERS)
+    data = orjson.loads(response.content)
+    buf = io.StringIO()
+    # PostgREST returns every row with the same column order, so write values positionally
+    writer = csv.writer(buf)
+    writer.writerow(data[0].keys())
+    writer.writerows(map(dict.values, data))
+    return buf.getvalue().encode()
 
 @app.post('/trips')
 async def trips(background_tasks: BackgroundTasks, channel_id: str = Form(...)):
@@ -62,14 +89,10 @@ async def trips(background_tasks: BackgroundTasks, channel_id: str = Form(...)):
     return Response(content='', status_code=200)
 
 async def handle_trips(channel_id: str):
-    csv_file = await fetch_data_and_save_as_csv("trips", "trips.csv")
-    try:
-        result = client.files_upload(channels=channel_id, file=csv_file, filename='trips.csv')
-        file_link = result['file']['permalink']
-        client.chat_postMessage(channel=channel_id, text=f"Trips data: <{file_link}|Download CSV>")
-    finally:
-        if os.path.exists(csv_file):
-            os.remove(csv_file)
+    csv_bytes = await fetch_data_as_csv("trips")
+    result = await client.files_upload_v2(channel=channel_id, content=csv_bytes, filename='trips.csv', title='Trips')
+    file_link = result['file']['permalink']
+    await client.chat_postMessage(channel=channel_id, text=f"Trips data: <{file_link}|Download CSV>")
 
 @app.post('/users')
 async def users(background_tasks: BackgroundTasks, channel_id: str = Form(...)):
@@ -77,66 +100,83 @@ async def users(background_tasks: BackgroundTasks, channel_id: str = Form(...)):
     return Response(content='', status_code=200)
 
 async def handle_users(channel_id: str):
-    csv_file = await fetch_data_and_save_as_csv("users", "users.csv")
-    try:
-        result = client.files_upload(channels=channel_id, file=csv_file, filename='users.csv')
-        file_link = result['file']['permalink']
-        client.chat_postMessage(channel=channel_id, text=f"Users data: <{file_link}|Download CSV>")
-    finally:
-        if os.path.exists(csv_file):
-            os.remove(csv_file)
+    csv_bytes = await fetch_data_as_csv("users")
+    result = await client.files_upload_v2(channel=channel_id, content=csv_bytes, filename='users.csv', title='Users')
+    file_link = result['file']['permalink']
+    await client.chat_postMessage(channel=channel_id, text=f"Users data: <{file_link}|Download CSV>")
+
+# List of all commands and their short descriptions
+_COMMANDS_LIST = {
+    "/trips": "provides a downloadable csv for all trips",
+    "/users": "provides a downloadable csv for all users",
+    "/message-count": "Shows the count of all messages",
+}
+
+# Formatting the response message
+_COMMANDS_TEXT = "\n".join([f"{cmd}: {desc}" for cmd, desc in _COMMANDS_LIST.items()])
+
+# The payload never changes, so serialize it once and reuse the response
+_COMMANDS_BODY = orjson.dumps({
+    "response_type": "ephemeral",  # Only the user who issued the command will see the response
+    "text": "Here are the available commands:\n" + _COMMANDS_TEXT
+})
+_COMMANDS_RESPONSE = Response(content=_COMMANDS_BODY, media_type="application/json")
 
 @app.post('/commands')
 async def commands():
-    # List of all commands and their short descriptions
-    commands_list = {
-        "/trips": "provides a downloadable csv for all trips",
-        "/users": "provides a downloadable csv for all users",
-        "/message-count": "Shows the count of all messages",    
-        }
-
-    # Formatting the response message
-    response_message = "\n".join([f"{cmd}: {desc}" for cmd, desc in commands_list.items()])
-
-    # Preparing the payload for Slack
-    payload = {
-        "response_type": "ephemeral",  # Only the user who issued the command will see the response
-        "text": "Here are the available commands:\n" + response_message
-    }
-
-    return JSONResponse(content=payload)
+    return _COMMANDS_RESPONSE
 
 @app.post('/slack/events')
-async def slack_events(request: Request, body: Dict = Body(...)):
-    # Verify Slack request
-    if request.headers.get('X-Slack-Signature') is None:
+async def slack_events(request: Request):
+    # Verify Slack request signature before parsing the payload
+    raw = await request.body()
+    if not verify_slack_signature(request, raw):
         return Response(status_code=403)
+    body = orjson.loads(raw)
 
     # Verification challenge
     if body.get('type') == 'url_verification':
-        return JSONResponse(content={"challenge": body['challenge']})
+        return ORJSONResponse(content={"challenge": body['challenge']})
 
     # Process event data
     await process_event_data(body)
     return Response(content='', status_code=200)
 
+def verify_slack_signature(request: Request, raw: bytes) -> bool:
+    timestamp = request.headers.get('X-Slack-Request-Timestamp')
+    signature = request.headers.get('X-Slack-Signature')
+    if timestamp is None or signature is None:
+        return False
+
+    # Reject requests older than five minutes to prevent replays
+    try:
+        if abs(time.time() - int(timestamp)) > 60 * 5:
+            return False
+    except ValueError:
+        return False
+
+    sig_basestring = b'v0:' + timestamp.encode() + b':' + raw
+    my_signature = b'v0=' + hmac.new(SLACK_SIGNING_SECRET, sig_basestring, hashlib.sha256).hexdigest().encode()
+    # Compare bytes; str comparison raises TypeError on non-ASCII header values
+    return hmac.compare_digest(my_signature, signature.encode('latin-1'))
+
 async def process_event_data(data):
     logger.info(f"Received data: {data}")
     if data['type'] == 'event_callback':
         event = data['event']
-        if event['type'] == 'message' and 'bot_id' not in event:
-            if f'<@{BOT_ID}>' in event['text']:
-                response = await generate_ai_response(event['text'])
-                logger.info(f"Generated response: {response}")
-                try:
-                    result = client.chat_postMessage(channel=event['channel'], text=response)
-                    logger.info(f"Message sent to Slack: {result}")
-                except SlackApiError as e:
-                    logger.error(f"Slack API Error: {e.response['error']}")
+        # The app subscribes to app_mention only, so every event here mentions the bot
+        if event['type'] == 'app_mention' and 'bot_id' not in event:
+            response = await generate_ai_response(event['text'])
+            logger.info(f"Generated response: {response}")
+            try:
+                result = await client.chat_postMessage(channel=event['channel'], text=response)
+                logger.info(f"Message sent to Slack: {result}")
+            except SlackApiError as e:
+                logger.error(f"Slack API Error: {e.response['error']}")
 
 async def generate_ai_response(input_text):
     # Remove the bot's mention and strip extra whitespace
-    processed_text = input_text.replace(f'<@{BOT_ID}>', '').strip()
+    processed_text = input_text.replace(BOT_MENTION, '').strip()
 
     # Log the processed text for debugging
     logger.info(f"Processing text: {processed_text}")
@@ -145,22 +185,26 @@ async def generate_ai_response(input_text):
     if processed_text.lower() in ["hello", "hi", "hey"]:
         return "Hello! How can I assist you today?"
 
-    # Adjusting model generation settings for more complex inputs
+    # Return a cached reply for prompts that only differ in case or surrounding whitespace
+    cache_key = hashlib.blake2b(processed_text.lower().encode(), digest_size=8).digest()
+    if cache_key in response_cache:
+        return response_cache[cache_key]
+
+    # Send the prompt to the completions endpoint
     try:
-        input_ids = tokenizer.encode(processed_text, return_tensors='pt')
-        output = model.generate(
-            input_ids,
-            max_length=50,
-            temperature=0.8,  # Adjust as needed
-            num_return_sequences=1,
-            do_sample=True,
-            top_k=50  # Limits the possible next words to increase coherence
-        )
-        response = tokenizer.decode(output[0], skip_special_tokens=True)
+        llm_response = await http_client.post(LLM_ENDPOINT, json={
+            "model": LLM_MODEL,
+            "prompt": processed_text,
+            "max_tokens": 40,
+            "temperature": 0
+        })
+        llm_response.raise_for_status()
+        response = orjson.loads(llm_response.content)['choices'][0]['text'].strip()
 
         # Post-process to remove or refine unwanted parts of the response
         # E.g., remove URLs, trim lengthy responses
 
+        response_cache[cache_key] = response
         return response
     except Exception as e:
         logger.error(f"Error generating response: {e}")
@@ -170,5 +214,13 @@ async def generate_ai_response(input_text):
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", reload=True)
+    # Each worker keeps its own message counts and response cache
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get('UVICORN_WORKERS', 1))
+    )
 